@@ -1,32 +1,101 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
-from models import db, User, Channel, Message, VoiceSession
+from models import db, User, Channel, Message, VoiceSession, ChannelStats, Attachment, AttachmentUploader
+from serialization import create_serializer, unwrap
+from history_cache import HistoryPageCache
+import read_state
+from password_hashing import PasswordHasher, LoginThrottle, HashingBusy
+from event_trace import EventTraceRecorder, HandlerProfiler
+from voice_recorder import VoiceRecordingManager, RecorderUnavailable, RecordingModeConflict
+from attachments import AttachmentStore, AttachmentError, INLINE_CONTENT_TYPES, can_access, attach_to_message, \
+    attachments_for_messages, forget_messages
 import os
-from datetime import datetime
+import atexit
+from datetime import datetime, timedelta
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.urandom(24)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///voicechat.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Socket.IO 序列化后端: 'auto' (orjson 优先, 否则标准库 json) | 'orjson' | 'json' | 'msgpack'
+app.config['SOCKETIO_SERIALIZER'] = 'auto'
+# 密码哈希在独立进程池中计算，请求线程不直接执行 KDF
+app.config['PASSWORD_HASH_METHOD'] = 'scrypt' # 修改后，旧哈希会在用户下次登录时自动重新计算
+app.config['PASSWORD_HASH_WORKERS'] = 2
+app.config['PASSWORD_HASH_MAX_PENDING'] = 64  # 排队中的哈希任务上限，超出时返回 503
+# 附件: 分块上传，按内容 sha256 去重存储在 instance/attachments 下
+app.config['ATTACHMENT_MAX_SIZE'] = 50 * 1024 * 1024
+app.config['ATTACHMENT_CHUNK_SIZE'] = 1024 * 1024     # 单次 PUT 的最大分块
+app.config['ATTACHMENT_MAX_OPEN_UPLOADS'] = 5         # 每个用户同时进行中的上传数上限
+app.config['ATTACHMENT_MAX_PENDING_BYTES'] = 100 * 1024 * 1024  # 每个用户进行中上传的总大小上限
+app.config['ATTACHMENT_UPLOAD_TTL_HOURS'] = 24        # 超过此时间未完成的上传会被清理
+# 部署在 nginx/Apache 后面时可开启，由前端服务器直接发送附件文件
+app.config['USE_X_SENDFILE'] = False
+# 语音频道录音 (管理员开启，用于审核)，文件保存在 instance/recordings 下
+app.config['VOICE_RECORDING_SAMPLE_RATE'] = 48000    # 需与客户端发送的采样率一致
+app.config['VOICE_RECORDING_SEGMENT_SECONDS'] = 30
+app.config['VOICE_RECORDING_RING_FRAMES'] = 1024     # 环形缓冲区容量 (音频帧)，写入跟不上时丢帧
+app.config['VOICE_RECORDING_MAX_FRAME_SAMPLES'] = 9600 # 单帧采样数上限 (48kHz 下 200ms)，超出的帧不录制
+# 每个录音频道的缓冲区最多占用 RING_FRAMES × MAX_FRAME_SAMPLES × 4 字节 (默认约 39 MB)
+# 性能分析 (默认关闭): 录制入站事件供 replay_trace.py 回放 / 对事件处理函数做 cProfile 分析
+app.config['EVENT_TRACE_PATH'] = os.environ.get('ARC_EVENT_TRACE')
+app.config['EVENT_PROFILE_PATH'] = os.environ.get('ARC_EVENT_PROFILE')
 
 # Constants for message loading
 INITIAL_MESSAGE_LOAD_COUNT = 20
 OLDER_MESSAGE_LOAD_COUNT = 20
+HISTORY_CACHE_MAX_PAGES = 512
+
+# Constants for reconnect resync
+RESYNC_PAGE_SIZE = 50      # Max newer messages returned per channel per request
+RESYNC_MAX_GAP = 200       # Beyond this many missed messages, send a fresh page instead
+RESYNC_MAX_CHANNELS = 50   # Max channels in one resume_text_channels request
 
 # 初始化扩展
+# 注意: 密码哈希进程池以 spawn 方式启动时，工作进程会重新导入本文件 (见 password_hashing.py)，
+# 以下模块级代码必须保持可以安全导入: 只创建对象和 (幂等地) 创建目录，不启动线程/进程、不写文件。
 db.init_app(app)
-socketio = SocketIO(app)
+socket_serializer = create_serializer(app.config['SOCKETIO_SERIALIZER'])
+socketio = SocketIO(app, **socket_serializer.socketio_options())
 login_manager = LoginManager(app)
+password_hasher = PasswordHasher(method=app.config['PASSWORD_HASH_METHOD'],
+                                 workers=app.config['PASSWORD_HASH_WORKERS'],
+                                 max_pending=app.config['PASSWORD_HASH_MAX_PENDING'])
+login_throttle = LoginThrottle()
+voice_recordings = VoiceRecordingManager(os.path.join(app.instance_path, 'recordings'),
+                                         sample_rate=app.config['VOICE_RECORDING_SAMPLE_RATE'],
+                                         segment_seconds=app.config['VOICE_RECORDING_SEGMENT_SECONDS'],
+                                         ring_frames=app.config['VOICE_RECORDING_RING_FRAMES'],
+                                         max_frame_samples=app.config['VOICE_RECORDING_MAX_FRAME_SAMPLES'])
+atexit.register(voice_recordings.stop_all) # Flush the last segment of every recording
+attachment_store = AttachmentStore(os.path.join(app.instance_path, 'attachments'),
+                                   max_size=app.config['ATTACHMENT_MAX_SIZE'],
+                                   chunk_size=app.config['ATTACHMENT_CHUNK_SIZE'],
+                                   max_open_uploads=app.config['ATTACHMENT_MAX_OPEN_UPLOADS'],
+                                   max_pending_bytes=app.config['ATTACHMENT_MAX_PENDING_BYTES'],
+                                   upload_ttl=timedelta(hours=app.config['ATTACHMENT_UPLOAD_TTL_HOURS']))
 
 # 全局存储连接的用户状态 (user_id: {username, sid, online, avatar_url, is_admin})
 connected_users = {}
 
+# 已编码的历史消息页缓存 (channel, anchor, limit) -> payload
+history_cache = HistoryPageCache(max_entries=HISTORY_CACHE_MAX_PAGES)
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+def too_many_attempts_response(retry_after):
+    response = jsonify(success=False, message='尝试次数过多，请稍后再试')
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+def hashing_busy_response():
+    response = jsonify(success=False, message='服务器繁忙，请稍后再试')
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
 @login_manager.unauthorized_handler
 def unauthorized():
     # Return a 401 Unauthorized response for API clients
@@ -52,15 +121,35 @@ def login_api():
     data = request.get_json()
     if not data or not data.get('username') or not data.get('password'):
         return jsonify(success=False, message="Username and password required"), 400
+    if not isinstance(data.get('username'), str) or not isinstance(data.get('password'), str):
+        return jsonify(success=False, message="Username and password must be strings"), 400
     
-    user = User.query.filter_by(username=data.get('username')).first()
-    if user and check_password_hash(user.password, data.get('password')):
+    username = data.get('username')
+    retry_after = login_throttle.check(username, request.remote_addr)
+    if retry_after:
+        return too_many_attempts_response(retry_after)
+
+    user = User.query.filter_by(username=username).first()
+    password_ok = False
+    if user:
+        try:
+            password_ok, upgraded_hash = password_hasher.verify(user.password, data.get('password'))
+        except HashingBusy:
+            return hashing_busy_response()
+        if password_ok and upgraded_hash:
+            # Stored hash used outdated parameters; replace it transparently
+            user.password = upgraded_hash
+            db.session.commit()
+
+    if password_ok:
+        login_throttle.record_success(username)
         login_user(user)
         # TODO: Consider session management/token for desktop app if needed beyond SocketIO auth
         return jsonify(
             success=True, 
             user={'id': user.id, 'username': user.username, 'avatar_url': user.avatar_url, 'is_admin': user.is_admin}
         )
+    login_throttle.record_failure(username)
     return jsonify(success=False, message='用户名或密码错误'), 401
 
 # 路由: 注册 API
@@ -76,6 +165,12 @@ def register_api():
 
     if not username or not password:
         return jsonify(success=False, message="Username and password required"), 400
+    if not isinstance(username, str) or not isinstance(password, str):
+        return jsonify(success=False, message="Username and password must be strings"), 400
+
+    retry_after = login_throttle.check(None, request.remote_addr)
+    if retry_after:
+        return too_many_attempts_response(retry_after)
     
     # For simplicity, invite code check can be basic for now
     if invite_code != 'ARC2015': 
@@ -84,7 +179,10 @@ def register_api():
     if User.query.filter_by(username=username).first():
         return jsonify(success=False, message='用户名已存在'), 409 # 409 Conflict
             
-    hashed_password = generate_password_hash(password)
+    try:
+        hashed_password = password_hasher.hash(password)
+    except HashingBusy:
+        return hashing_busy_response()
     new_user = User(username=username, password=hashed_password)
     db.session.add(new_user)
     db.session.commit()
@@ -147,6 +245,7 @@ def update_settings_api():
 
     try:
         db.session.commit()
+        history_cache.clear() # Cached history pages embed the old avatar_url
         return jsonify(
             success=True, 
             message='设置已成功保存', 
@@ -199,6 +298,8 @@ def create_channel_api():
              new_channel.members.append(current_user)
             
     try:
+        db.session.flush() # Assigns new_channel.id
+        read_state.init_channel_stats(new_channel.id)
         db.session.commit()
         return jsonify(
             success=True, 
@@ -214,6 +315,103 @@ def create_channel_api():
         db.session.rollback()
         return jsonify(success=False, message=f"创建频道失败: {str(e)}"), 500
 
+# API: 创建分块上传任务
+@app.route('/api/attachments/uploads', methods=['POST'])
+@login_required
+def create_attachment_upload_api():
+    data = request.get_json()
+    if not data:
+        return jsonify(success=False, message="Request body cannot be empty"), 400
+
+    try:
+        upload = attachment_store.start_upload(current_user.id, data.get('filename'),
+                                               data.get('size'), data.get('content_type'))
+    except AttachmentError as e:
+        return jsonify(success=False, message=e.message), e.status
+    return jsonify(success=True, upload_id=upload.id, received=upload.received,
+                   chunk_size=attachment_store.chunk_size), 201
+
+# API: 查询上传进度 (断点续传时从 received 继续)
+@app.route('/api/attachments/uploads/<upload_id>', methods=['GET'])
+@login_required
+def get_attachment_upload_api(upload_id):
+    try:
+        upload = attachment_store.get_upload(upload_id, current_user.id)
+    except AttachmentError as e:
+        return jsonify(success=False, message=e.message), e.status
+    return jsonify(success=True, upload_id=upload.id, received=upload.received, size=upload.size)
+
+# API: 上传一个分块，请求体为原始字节，?offset= 必须等于已接收的字节数
+@app.route('/api/attachments/uploads/<upload_id>', methods=['PUT'])
+@login_required
+def put_attachment_chunk_api(upload_id):
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify(success=False, message="offset is required"), 400
+
+    try:
+        upload = attachment_store.get_upload(upload_id, current_user.id)
+        # request.stream is read block by block; the chunk is never held in memory
+        upload = attachment_store.append_chunk(upload, offset, request.stream, request.content_length)
+    except AttachmentError as e:
+        return jsonify(success=False, message=e.message), e.status
+    return jsonify(success=True, upload_id=upload.id, received=upload.received, size=upload.size)
+
+# API: 完成上传，返回附件 ID (内容 sha256)
+@app.route('/api/attachments/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_attachment_upload_api(upload_id):
+    try:
+        upload = attachment_store.get_upload(upload_id, current_user.id)
+        attachment, filename = attachment_store.complete_upload(upload)
+    except AttachmentError as e:
+        return jsonify(success=False, message=e.message), e.status
+    return jsonify(success=True, attachment_id=attachment.sha256, filename=filename,
+                   size=attachment.size, content_type=attachment.content_type)
+
+# API: 取消上传
+@app.route('/api/attachments/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+def cancel_attachment_upload_api(upload_id):
+    try:
+        upload = attachment_store.get_upload(upload_id, current_user.id)
+        attachment_store.cancel_upload(upload)
+    except AttachmentError as e:
+        return jsonify(success=False, message=e.message), e.status
+    return jsonify(success=True, message='上传已取消')
+
+# API: 下载附件 (默认作为下载返回，只有安全类型在 ?inline=1 时内联显示)
+@app.route('/api/attachments/<attachment_id>', methods=['GET'])
+@login_required
+def download_attachment_api(attachment_id):
+    attachment = Attachment.query.get(attachment_id)
+    # Same 404 for "no such file" and "not allowed", so hashes can't be probed
+    if not attachment or not can_access(current_user, attachment.sha256):
+        return jsonify(success=False, message='附件不存在'), 404
+    path = attachment_store.object_path(attachment.sha256)
+    if not os.path.exists(path):
+        return jsonify(success=False, message='附件不存在'), 404
+
+    # The content type comes from the uploader; never let it turn into HTML/SVG on our origin
+    inline = request.args.get('inline') == '1' and attachment.content_type in INLINE_CONTENT_TYPES
+    mimetype = attachment.content_type if attachment.content_type in INLINE_CONTENT_TYPES else 'application/octet-stream'
+
+    # conditional=True answers Range / If-None-Match requests; a full response
+    # goes through wsgi.file_wrapper (sendfile where the server supports it).
+    # Content never changes for a given sha256, so it can be cached privately forever.
+    response = send_file(path,
+                         mimetype=mimetype,
+                         as_attachment=not inline,
+                         download_name=request.args.get('filename') or attachment.sha256,
+                         conditional=True,
+                         etag=attachment.sha256,
+                         max_age=31536000)
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['Content-Security-Policy'] = "default-src 'none'; sandbox"
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
 # WebSocket: 连接事件
 @socketio.on('connect')
 def handle_connect():
@@ -232,6 +430,15 @@ def handle_connect():
         
         # 向所有客户端广播更新的用户列表
         emit('server_user_list_update', list(connected_users.values()), broadcast=True)
+
+        # 推送未读计数摘要 {channel_id: unread_count}，只包含有未读消息的文字频道
+        visible_text_channel_ids = [
+            ch.id for ch in Channel.query.filter_by(channel_type='text').all()
+            if current_user.is_admin or not ch.is_private or current_user in ch.members
+        ]
+        emit('unread_summary', {
+            'unread': read_state.unread_summary(current_user.id, visible_text_channel_ids)
+        }, room=request.sid)
         
         # 也单独给当前连接的用户发送一次完整的列表 (以防万一广播稍早于其准备好接收)
         # emit('server_user_list_update', list(connected_users.values()), room=request.sid)
@@ -263,6 +470,7 @@ def handle_disconnect():
             
             db.session.delete(session)
             db.session.commit()
+            voice_recordings.forget_speaker(current_user.id)
             print(f"Cleaned up voice session for user {current_user.id} from channel {channel_id_being_left}")
 
         if current_user.id in connected_users:
@@ -275,9 +483,55 @@ def handle_disconnect():
 # WebSocket: 加入文字频道
 @socketio.on('join_text_channel')
 def handle_join_text_channel(data):
-    channel_id = data['channel_id']
+    channel_id = data.get('channel_id') if isinstance(data, dict) else None
+    # Validate before touching the cache, so unknown ids can't fill or flush it
+    channel = get_readable_text_channel(channel_id)
+    if not channel:
+        emit('error', {'message': '频道不存在或没有访问权限'}, room=request.sid)
+        return
     join_room(f"text_channel_{channel_id}")
 
+    # The latest page is identical for every client until a new message arrives,
+    # so it is built and encoded once and served from the cache afterwards.
+    page = history_cache.get_or_build(channel.id, None, INITIAL_MESSAGE_LOAD_COUNT,
+                                      lambda: build_initial_history_page(channel.id))
+    emit('load_historical_messages', page, room=request.sid)
+
+    # Opening a channel shows its latest messages, so it counts as reading it
+    read_state.mark_read(current_user.id, channel.id)
+
+    payload = unwrap(page)
+    print(f"User {current_user.username} joined text channel {channel_id}, sent {len(payload['messages'])} initial messages. Has more: {payload['has_more_older']}")
+
+def get_readable_text_channel(channel_id):
+    # The text channel with this id if the current user may read it, else None
+    try:
+        channel = Channel.query.get(int(channel_id))
+    except (TypeError, ValueError):
+        return None
+    if not channel or channel.channel_type != 'text':
+        return None
+    if channel.is_private and not current_user.is_admin and current_user not in channel.members:
+        return None
+    return channel
+
+def format_message_for_client(msg, sender, attachments=None):
+    formatted = {
+        'channel_id': msg.channel_id,
+        'message_id': msg.id, # Important for fetching older messages
+        'content': msg.content,
+        'username': sender.username if sender else 'Unknown User',
+        'user_id': msg.user_id,
+        'avatar_url': sender.avatar_url if sender else None,
+        'timestamp': msg.timestamp.strftime('%H:%M:%S'),
+        'timestamp_iso': msg.timestamp.isoformat() # Full ISO timestamp for precise comparison
+    }
+    if attachments:
+        formatted['attachments'] = attachments # References only, the files are fetched over HTTP
+    return formatted
+
+def build_initial_history_page(channel_id):
+    # channel_id is a validated int: the page is cached and shared by every client
     # Fetch initial batch of messages (most recent ones)
     historical_messages_query = Message.query.filter_by(channel_id=channel_id)\
                                             .order_by(Message.timestamp.desc())\
@@ -287,31 +541,19 @@ def handle_join_text_channel(data):
     # Messages are fetched in descending order (newest first), reverse them for chronological display
     historical_messages_query.reverse() 
 
-    formatted_messages = []
-    for msg in historical_messages_query:
-        sender = User.query.get(msg.user_id)
-        formatted_messages.append({
-            'channel_id': msg.channel_id,
-            'message_id': msg.id, # Important for fetching older messages
-            'content': msg.content,
-            'username': sender.username if sender else 'Unknown User',
-            'user_id': msg.user_id,
-            'avatar_url': sender.avatar_url if sender else None,
-            'timestamp': msg.timestamp.strftime('%H:%M:%S'),
-            'timestamp_iso': msg.timestamp.isoformat() # Full ISO timestamp for precise comparison
-        })
+    attachments_by_message = attachments_for_messages([msg.id for msg in historical_messages_query])
+    formatted_messages = [format_message_for_client(msg, User.query.get(msg.user_id), attachments_by_message.get(msg.id))
+                          for msg in historical_messages_query]
     
-    # Check if there might be more older messages
-    total_messages_in_channel = Message.query.filter_by(channel_id=channel_id).count()
+    # Check if there might be more older messages (maintained counter, no COUNT scan)
+    total_messages_in_channel = read_state.channel_message_count(channel_id)
     has_more_older = total_messages_in_channel > len(formatted_messages)
 
-    emit('load_historical_messages', {
+    return socket_serializer.prepare({
         'channel_id': channel_id,
         'messages': formatted_messages,
         'has_more_older': has_more_older
-    }, room=request.sid)
-
-    print(f"User {current_user.username} joined text channel {channel_id}, sent {len(formatted_messages)} initial messages. Has more: {has_more_older}")
+    })
 
 @socketio.on('request_older_messages')
 def handle_request_older_messages(data):
@@ -326,15 +568,26 @@ def handle_request_older_messages(data):
     if not channel_id or not before_message_id:
         emit('error', {'message': 'Channel ID and before_message_id are required to load older messages.'}, room=request.sid)
         return
+    channel = get_readable_text_channel(channel_id)
+    if not channel:
+        emit('error', {'message': '频道不存在或没有访问权限'}, room=request.sid)
+        return
 
+    page = history_cache.get_or_build(channel.id, before_message_id, limit_count,
+                                      lambda: build_older_history_page(channel.id, before_message_id, limit_count))
+    emit('older_messages_loaded', page, room=request.sid)
+
+    payload = unwrap(page)
+    print(f"Sent {len(payload['messages'])} older messages to {current_user.username} for channel {channel_id}. Has more: {payload['has_more_older']}")
+
+def build_older_history_page(channel_id, before_message_id, limit_count):
     oldest_message_on_client = Message.query.get(before_message_id)
     if not oldest_message_on_client:
-        emit('older_messages_loaded', {
+        return socket_serializer.prepare({
             'channel_id': channel_id,
             'messages': [],
             'has_more_older': False # Cannot find the reference message
-        }, room=request.sid)
-        return
+        })
 
     older_messages_query = Message.query.filter(
                                         Message.channel_id == channel_id,
@@ -346,19 +599,9 @@ def handle_request_older_messages(data):
     
     older_messages_query.reverse() # Reverse for chronological order
 
-    formatted_older_messages = []
-    for msg in older_messages_query:
-        sender = User.query.get(msg.user_id)
-        formatted_older_messages.append({
-            'channel_id': msg.channel_id,
-            'message_id': msg.id,
-            'content': msg.content,
-            'username': sender.username if sender else 'Unknown User',
-            'user_id': msg.user_id,
-            'avatar_url': sender.avatar_url if sender else None,
-            'timestamp': msg.timestamp.strftime('%H:%M:%S'),
-            'timestamp_iso': msg.timestamp.isoformat()
-        })
+    attachments_by_message = attachments_for_messages([msg.id for msg in older_messages_query])
+    formatted_older_messages = [format_message_for_client(msg, User.query.get(msg.user_id), attachments_by_message.get(msg.id))
+                                for msg in older_messages_query]
 
     # Check if there are even more messages older than this batch
     # This check can be more precise by looking for a message older than the oldest one in the current batch sent
@@ -372,18 +615,99 @@ def handle_request_older_messages(data):
         if more_exist_check:
             has_even_more_older = True
             
-    emit('older_messages_loaded', {
+    return socket_serializer.prepare({
         'channel_id': channel_id,
         'messages': formatted_older_messages,
         'has_more_older': has_even_more_older 
-    }, room=request.sid)
-    print(f"Sent {len(formatted_older_messages)} older messages to {current_user.username} for channel {channel_id}. Has more: {has_even_more_older}")
+    })
+
+# WebSocket: 断线重连后的增量同步
+# 客户端一次性发送每个频道最后看到的消息 ID，服务端只返回更新的消息:
+#   {'channels': [{'channel_id': 1, 'last_message_id': 42}, ...]}
+@socketio.on('resume_text_channels')
+def handle_resume_text_channels(data):
+    if not current_user.is_authenticated:
+        return
+
+    requested = data.get('channels') if isinstance(data, dict) else None
+    if not isinstance(requested, list):
+        emit('error', {'message': 'channels list is required to resume text channels.'}, room=request.sid)
+        return
+
+    last_seen_by_channel = {}
+    for entry in requested[:RESYNC_MAX_CHANNELS]:
+        if not isinstance(entry, dict) or entry.get('channel_id') is None:
+            continue
+        try:
+            last_seen = entry.get('last_message_id')
+            last_seen_by_channel[int(entry['channel_id'])] = int(last_seen) if last_seen is not None else None
+        except (TypeError, ValueError):
+            continue
+
+    channels = Channel.query.filter(Channel.id.in_(list(last_seen_by_channel)),
+                                    Channel.channel_type == 'text').all()
+    stats_by_channel = {st.channel_id: st for st in
+                        ChannelStats.query.filter(ChannelStats.channel_id.in_([ch.id for ch in channels])).all()}
+
+    results = []
+    for channel in channels:
+        if channel.is_private and not current_user.is_admin and current_user not in channel.members:
+            continue
+        join_room(f"text_channel_{channel.id}")
+
+        last_seen = last_seen_by_channel[channel.id]
+        stats = stats_by_channel.get(channel.id)
+        if last_seen is not None and stats is not None and stats.last_message_id is not None \
+                and last_seen >= stats.last_message_id:
+            # Client is already up to date, no need to touch the Message table
+            results.append({'channel_id': channel.id, 'messages': [], 'has_more_newer': False})
+            continue
+
+        newer_messages = []
+        gap_too_large = last_seen is None
+        if not gap_too_large:
+            newer_messages = Message.query.filter(Message.channel_id == channel.id, Message.id > last_seen)\
+                                          .order_by(Message.id.asc())\
+                                          .limit(RESYNC_PAGE_SIZE + 1)\
+                                          .all()
+            if len(newer_messages) > RESYNC_PAGE_SIZE:
+                gap_too_large = Message.query.filter(Message.channel_id == channel.id, Message.id > last_seen)\
+                                             .order_by(Message.id.asc())\
+                                             .offset(RESYNC_MAX_GAP)\
+                                             .first() is not None
+
+        if gap_too_large:
+            # Fall back to the (cached) latest page, same as join_text_channel
+            page = history_cache.get_or_build(channel.id, None, INITIAL_MESSAGE_LOAD_COUNT,
+                                              lambda: build_initial_history_page(channel.id))
+            emit('load_historical_messages', page, room=request.sid)
+            results.append({'channel_id': channel.id, 'reset': True})
+            continue
+
+        has_more_newer = len(newer_messages) > RESYNC_PAGE_SIZE
+        newer_messages = newer_messages[:RESYNC_PAGE_SIZE]
+        senders = {u.id: u for u in User.query.filter(User.id.in_({m.user_id for m in newer_messages})).all()} \
+            if newer_messages else {}
+        attachments_by_message = attachments_for_messages([msg.id for msg in newer_messages])
+        results.append({
+            'channel_id': channel.id,
+            'messages': [format_message_for_client(msg, senders.get(msg.user_id), attachments_by_message.get(msg.id))
+                         for msg in newer_messages],
+            'has_more_newer': has_more_newer # Client resumes again from the last message it received
+        })
+
+    emit('text_channels_resumed', {'channels': results}, room=request.sid)
+    print(f"User {current_user.username} resumed {len(results)} text channel(s).")
 
 # WebSocket: 发送消息
 @socketio.on('send_message')
 def handle_message(data):
     channel_id = data['channel_id']
-    content = data['message']
+    content = data.get('message') or ''
+    attachment_refs = data.get('attachments') # [{'attachment_id': sha256, 'filename': ...}] from the upload API
+    if not content and not attachment_refs:
+        emit('error', {'message': '消息内容不能为空'})
+        return
     
     target_channel = Channel.query.get(channel_id)
     if not target_channel:
@@ -403,10 +727,21 @@ def handle_message(data):
         channel_id=channel_id
     )
     db.session.add(new_message)
+    db.session.flush() # Assigns new_message.id
+    attachments = []
+    if attachment_refs:
+        try:
+            attachments = attach_to_message(current_user, new_message.id, attachment_refs)
+        except AttachmentError as e:
+            db.session.rollback()
+            emit('error', {'message': e.message})
+            return
+    read_state.record_message(target_channel.id, new_message.id, current_user.id)
     db.session.commit()
+    history_cache.invalidate_channel(channel_id)
     
     # 广播消息
-    emit('new_message', {
+    message_payload = {
         'channel_id': channel_id,
         'message_id': new_message.id,
         'content': content,
@@ -414,7 +749,29 @@ def handle_message(data):
         'user_id': current_user.id,
         'avatar_url': current_user.avatar_url,
         'timestamp': new_message.timestamp.strftime('%H:%M:%S')
-    }, room=f"text_channel_{channel_id}")
+    }
+    if attachments:
+        message_payload['attachments'] = attachments
+    emit('new_message', message_payload, room=f"text_channel_{channel_id}")
+
+# WebSocket: 标记频道已读
+@socketio.on('mark_channel_read')
+def handle_mark_channel_read(data):
+    if not current_user.is_authenticated:
+        return
+
+    channel = get_readable_text_channel(data.get('channel_id')) if isinstance(data, dict) else None
+    if not channel:
+        emit('error', {'message': '频道不存在或没有访问权限'}, room=request.sid)
+        return
+
+    state = read_state.mark_read(current_user.id, channel.id)
+    # Let the user's other sessions clear their badge as well
+    emit('channel_read_state', {
+        'channel_id': state.channel_id,
+        'last_read_message_id': state.last_read_message_id,
+        'unread': 0
+    }, room=f"user_{current_user.id}")
 
 # WebSocket: 加入语音频道
 @socketio.on('join_voice_channel')
@@ -443,6 +800,7 @@ def handle_join_voice_channel(data):
             old_channel_id = existing_session.channel_id
             leave_room(f"voice_channel_{old_channel_id}")
             db.session.delete(existing_session)
+            voice_recordings.forget_speaker(current_user.id)
             emit('user_left_voice', {
                 'channel_id': old_channel_id,
                 'user_id': current_user.id,
@@ -458,6 +816,7 @@ def handle_join_voice_channel(data):
         db.session.add(new_session)
     
     db.session.commit()
+    voice_recordings.set_speaker(current_user.id, target_channel.id)
     
     join_room(f"voice_channel_{channel_id}")
     
@@ -466,7 +825,8 @@ def handle_join_voice_channel(data):
     
     emit('voice_channel_users', {
         'channel_id': channel_id,
-        'users': user_list
+        'users': user_list,
+        'recording': voice_recordings.get(target_channel.id) is not None
     }, room=request.sid)
 
     if not user_was_already_in_target_channel:
@@ -502,6 +862,7 @@ def handle_leave_voice_channel(data): # Expecting data to contain channel_id fro
         leave_room(f"voice_channel_{channel_id_to_leave}")
         db.session.delete(session)
         db.session.commit()
+        voice_recordings.forget_speaker(current_user.id)
         
         emit('user_left_voice', {
             'channel_id': channel_id_to_leave,
@@ -563,6 +924,9 @@ def handle_voice_data_stream(data):
              room=room_name, 
          skip_sid=request.sid) # Still skip SID for the audio data itself to avoid self-playback of raw audio
 
+    # 3. Tap the frame for recording if enabled (non-blocking, no disk I/O here)
+    voice_recordings.tap(channel_id, user_id, audio_data)
+
 # WebSocket: WebRTC信令
 @socketio.on('voice_signal')
 def handle_voice_signal(data):
@@ -626,6 +990,9 @@ def delete_user_api(user_id):
 
     try:
         # Consider cascading deletes in DB or more robust cleanup
+        read_state.forget_user_messages(user_to_delete.id)
+        forget_messages(db.select(Message.id).where(Message.user_id == user_to_delete.id))
+        AttachmentUploader.query.filter_by(user_id=user_to_delete.id).delete()
         Message.query.filter_by(user_id=user_to_delete.id).delete()
         VoiceSession.query.filter_by(user_id=user_to_delete.id).delete()
         # Remove user from channel memberships
@@ -634,6 +1001,8 @@ def delete_user_api(user_id):
 
         db.session.delete(user_to_delete)
         db.session.commit()
+        voice_recordings.forget_speaker(user_to_delete.id)
+        history_cache.clear() # The user's messages were removed from every channel
         return jsonify(success=True, message=f'用户 {user_to_delete.username} 已被成功删除')
     except Exception as e:
         db.session.rollback()
@@ -685,6 +1054,55 @@ def edit_channel_api(channel_id):
         db.session.rollback()
         return jsonify(success=False, message=f"更新频道失败: {str(e)}"), 500
 
+# API: Get voice channel recording status (Admin only)
+@app.route('/api/admin/channels/<int:channel_id>/recording', methods=['GET'])
+@login_required
+def get_channel_recording_api(channel_id):
+    if not current_user.is_admin:
+        return jsonify(success=False, message='仅限管理员访问'), 403
+
+    recorder = voice_recordings.get(channel_id)
+    return jsonify(success=True, recording=recorder is not None,
+                   status=recorder.status() if recorder else None)
+
+# API: Start/stop recording a voice channel (Admin only)
+@app.route('/api/admin/channels/<int:channel_id>/recording', methods=['POST'])
+@login_required
+def set_channel_recording_api(channel_id):
+    if not current_user.is_admin:
+        return jsonify(success=False, message='仅限管理员访问'), 403
+
+    data = request.get_json()
+    if not data or not isinstance(data.get('enabled'), bool):
+        return jsonify(success=False, message="enabled 必须是布尔值"), 400
+
+    channel = Channel.query.get(channel_id)
+    if not channel:
+        return jsonify(success=False, message='频道未找到'), 404
+    if channel.channel_type != 'voice':
+        return jsonify(success=False, message='目标频道不是语音频道'), 400
+
+    if data['enabled']:
+        mode = data.get('mode', 'mix') # 'mix': one mixed track, 'tracks': one file per speaker
+        if mode not in ('mix', 'tracks'):
+            return jsonify(success=False, message="mode 必须是 'mix' 或 'tracks'"), 400
+        try:
+            members = [s.user_id for s in VoiceSession.query.filter_by(channel_id=channel_id).all()]
+            recorder = voice_recordings.start(channel_id, mode=mode, members=members)
+        except RecorderUnavailable as e:
+            return jsonify(success=False, message=str(e)), 501
+        except RecordingModeConflict as e:
+            return jsonify(success=False, message=str(e), mode=e.mode), 409
+        status = recorder.status()
+    else:
+        recorder = voice_recordings.stop(channel_id)
+        status = recorder.status() if recorder else None
+
+    # Let everyone in the channel know whether they are being recorded
+    socketio.emit('voice_recording_status', {'channel_id': channel_id, 'recording': data['enabled']},
+                  room=f"voice_channel_{channel_id}")
+    return jsonify(success=True, recording=data['enabled'], status=status)
+
 # API: Delete a channel (Admin only)
 @app.route('/api/admin/channels/<int:channel_id>', methods=['DELETE'])
 @login_required
@@ -698,6 +1116,9 @@ def delete_channel_api(channel_id):
 
     try:
         # Consider cascading deletes in DB or more robust cleanup
+        voice_recordings.stop(channel_to_delete.id)
+        read_state.forget_channel(channel_to_delete.id)
+        forget_messages(db.select(Message.id).where(Message.channel_id == channel_to_delete.id))
         Message.query.filter_by(channel_id=channel_to_delete.id).delete()
         VoiceSession.query.filter_by(channel_id=channel_to_delete.id).delete()
         # Clear members from the channel
@@ -705,15 +1126,27 @@ def delete_channel_api(channel_id):
 
         db.session.delete(channel_to_delete)
         db.session.commit()
+        voice_recordings.forget_channel(channel_to_delete.id)
+        history_cache.invalidate_channel(channel_id)
         return jsonify(success=True, message=f'频道 {channel_to_delete.name} 已被成功删除')
     except Exception as e:
         db.session.rollback()
         return jsonify(success=False, message=f"删除频道失败: {str(e)}"), 500
 
+# 事件录制与分析钩子需要在所有 @socketio.on 处理函数注册之后安装；
+# 密码哈希工作进程 (__mp_main__) 不处理事件，不安装
+if __name__ != '__mp_main__':
+    if app.config['EVENT_TRACE_PATH']:
+        EventTraceRecorder(app.config['EVENT_TRACE_PATH']).install(socketio)
+    if app.config['EVENT_PROFILE_PATH']:
+        HandlerProfiler(app.config['EVENT_PROFILE_PATH']).install(socketio)
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
         create_initial_data()
+        read_state.seed_channel_stats()
+        attachment_store.expire_stale_uploads()
     
     # 启动 Flask-SocketIO 应用，并启用 SSL
     # 重要: 将 'path/to/your/cert.pem' 和 'path/to/your/key.pem' 替换为您的实际文件路径
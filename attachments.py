@@ -0,0 +1,284 @@
+# 文件附件
+# 分块上传直接流式写入磁盘 (不在内存中缓存整个文件)，支持断点续传；
+# 完成后按内容 sha256 存储并去重。消息只保存附件引用。
+import hashlib
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from models import db, Channel, Message, Attachment, AttachmentUpload, AttachmentUploader, MessageAttachment
+
+STREAM_BLOCK_SIZE = 64 * 1024
+HASH_LOCK_STRIPES = 64
+EXPIRE_INTERVAL = 300  # 最多每 5 分钟在新建上传时清理一次过期上传 (秒)
+MAX_ATTACHMENTS_PER_MESSAGE = 10
+
+# Types that browsers render without executing script; everything else is
+# served as a download. SVG and HTML are deliberately absent.
+INLINE_CONTENT_TYPES = {
+    'image/png', 'image/jpeg', 'image/gif', 'image/webp',
+    'audio/mpeg', 'audio/ogg', 'audio/wav', 'audio/webm',
+    'video/mp4', 'video/webm',
+    'text/plain'
+}
+
+
+class AttachmentError(Exception):
+    # Carries an HTTP status for the API layer
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class AttachmentStore:
+    def __init__(self, root, max_size, chunk_size, max_open_uploads=5, max_pending_bytes=None,
+                 upload_ttl=timedelta(days=1)):
+        self.root = root
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.max_open_uploads = max_open_uploads      # Per user
+        self.max_pending_bytes = max_pending_bytes or 2 * max_size  # Per user, sum of declared sizes
+        self.upload_ttl = upload_ttl
+        self._last_expired = 0.0
+        self._upload_locks = {}
+        self._locks_guard = threading.Lock()
+        # Serialises completion of identical content within this process;
+        # other processes are handled by the primary key on Attachment
+        self._hash_locks = [threading.Lock() for _ in range(HASH_LOCK_STRIPES)]
+        os.makedirs(os.path.join(root, 'uploads'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+
+    def partial_path(self, upload_id):
+        return os.path.join(self.root, 'uploads', f"{upload_id}.part")
+
+    def object_path(self, sha256):
+        # Fan out into sub-directories so no single directory grows too large
+        return os.path.join(self.root, 'objects', sha256[:2], sha256[2:4], sha256)
+
+    def _lock_for(self, upload_id):
+        with self._locks_guard:
+            return self._upload_locks.setdefault(upload_id, threading.Lock())
+
+    def _release_lock(self, upload_id):
+        with self._locks_guard:
+            self._upload_locks.pop(upload_id, None)
+
+    def start_upload(self, user_id, filename, size, content_type=None):
+        if not filename or not isinstance(size, int) or size <= 0:
+            raise AttachmentError("filename and a positive size are required")
+        if not isinstance(filename, str) or not isinstance(content_type, (str, type(None))):
+            raise AttachmentError("filename and content_type must be strings")
+        if size > self.max_size:
+            raise AttachmentError(f"文件过大，最大允许 {self.max_size} 字节", 413)
+
+        if time.monotonic() - self._last_expired >= EXPIRE_INTERVAL:
+            self.expire_stale_uploads()
+
+        open_count, pending_bytes = db.session.query(
+            func.count(AttachmentUpload.id), func.coalesce(func.sum(AttachmentUpload.size), 0)
+        ).filter(AttachmentUpload.user_id == user_id).one()
+        if open_count >= self.max_open_uploads:
+            raise AttachmentError(f"进行中的上传过多，最多 {self.max_open_uploads} 个", 429)
+        if pending_bytes + size > self.max_pending_bytes:
+            raise AttachmentError("进行中的上传总大小超出限制", 429)
+
+        upload = AttachmentUpload(
+            id=uuid.uuid4().hex,
+            user_id=user_id,
+            filename=os.path.basename(filename)[:255],
+            content_type=(content_type or None) and content_type[:100],
+            size=size,
+            received=0
+        )
+        open(self.partial_path(upload.id), 'wb').close()
+        db.session.add(upload)
+        db.session.commit()
+        return upload
+
+    def get_upload(self, upload_id, user_id):
+        upload = AttachmentUpload.query.get(upload_id)
+        if not upload or upload.user_id != user_id:
+            raise AttachmentError("上传任务不存在", 404)
+        return upload
+
+    def append_chunk(self, upload, offset, stream, length):
+        # Streams `length` bytes from `stream` to the partial file at `offset`.
+        # The offset must equal what was already received, which makes retried
+        # or resumed chunks safe: the client asks for `received` and continues.
+        if length is None or length <= 0:
+            raise AttachmentError("Content-Length is required", 411)
+        if length > self.chunk_size:
+            raise AttachmentError(f"分块过大，最大允许 {self.chunk_size} 字节", 413)
+
+        with self._lock_for(upload.id):
+            db.session.refresh(upload)
+            if offset != upload.received:
+                raise AttachmentError(f"offset 应为 {upload.received}", 409)
+            if upload.received + length > upload.size:
+                raise AttachmentError("数据超出声明的文件大小", 413)
+
+            written = 0
+            with open(self.partial_path(upload.id), 'r+b') as part:
+                part.seek(offset)
+                while written < length:
+                    block = stream.read(min(STREAM_BLOCK_SIZE, length - written))
+                    if not block:
+                        break
+                    part.write(block)
+                    written += len(block)
+                # Drop anything past what was actually received (e.g. a client
+                # that disconnected mid-chunk) so the next offset is consistent
+                part.truncate(offset + written)
+
+            upload.received = offset + written
+            db.session.commit()
+        return upload
+
+    def complete_upload(self, upload):
+        with self._lock_for(upload.id):
+            db.session.refresh(upload)
+            if upload.received != upload.size:
+                raise AttachmentError(f"上传未完成 ({upload.received}/{upload.size})", 409)
+
+            partial = self.partial_path(upload.id)
+            if not os.path.exists(partial):
+                # Data was lost (e.g. crash mid-completion); the client must start over
+                db.session.delete(upload)
+                db.session.commit()
+                raise AttachmentError("上传数据丢失，请重新上传", 410)
+
+            digest = hashlib.sha256()
+            with open(partial, 'rb') as part:
+                for block in iter(lambda: part.read(STREAM_BLOCK_SIZE), b''):
+                    digest.update(block)
+            sha256 = digest.hexdigest()
+
+            with self._hash_locks[int(sha256[:8], 16) % HASH_LOCK_STRIPES]:
+                # The row is committed before the file is moved, so a failed move
+                # leaves the partial file in place and `complete` can be retried
+                attachment = self._get_or_create(
+                    Attachment, sha256,
+                    dict(sha256=sha256, size=upload.size, content_type=upload.content_type))
+                target = self.object_path(sha256)
+                if os.path.exists(target):
+                    os.remove(partial) # Same content already stored
+                else:
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    os.replace(partial, target)
+
+            self._get_or_create(AttachmentUploader, (sha256, upload.user_id),
+                                dict(attachment_sha256=sha256, user_id=upload.user_id))
+            filename = upload.filename
+            db.session.delete(upload)
+            db.session.commit()
+        self._release_lock(upload.id)
+        return attachment, filename
+
+    @staticmethod
+    def _get_or_create(model, key, values):
+        row = model.query.get(key)
+        if row is not None:
+            return row
+        db.session.add(model(**values))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another worker process inserted the same row first: a dedupe hit
+            db.session.rollback()
+        return model.query.get(key)
+
+    def cancel_upload(self, upload):
+        with self._lock_for(upload.id):
+            if os.path.exists(self.partial_path(upload.id)):
+                os.remove(self.partial_path(upload.id))
+            db.session.delete(upload)
+            db.session.commit()
+        self._release_lock(upload.id)
+
+    def expire_stale_uploads(self):
+        # Runs at startup and, at most every EXPIRE_INTERVAL, when an upload starts
+        self._last_expired = time.monotonic()
+        cutoff = datetime.utcnow() - self.upload_ttl
+        stale = AttachmentUpload.query.filter(AttachmentUpload.created_at < cutoff).all()
+        removed = 0
+        for upload in stale:
+            lock = self._lock_for(upload.id)
+            if not lock.acquire(blocking=False):
+                continue # A chunk is being written right now; try again next time
+            try:
+                if os.path.exists(self.partial_path(upload.id)):
+                    os.remove(self.partial_path(upload.id))
+                db.session.delete(upload)
+                removed += 1
+            finally:
+                lock.release()
+            self._release_lock(upload.id)
+        db.session.commit()
+        if removed:
+            print(f"Removed {removed} stale attachment upload(s).")
+
+
+def can_access(user, sha256):
+    # Uploaders can always fetch their files; anyone else needs to be able to
+    # see a channel where a message links to the attachment
+    if user.is_admin or AttachmentUploader.query.get((sha256, user.id)):
+        return True
+    channels = db.session.query(Channel)\
+        .join(Message, Message.channel_id == Channel.id)\
+        .join(MessageAttachment, MessageAttachment.message_id == Message.id)\
+        .filter(MessageAttachment.attachment_sha256 == sha256)\
+        .distinct()\
+        .all()
+    return any(not ch.is_private or user in ch.members for ch in channels)
+
+def attach_to_message(user, message_id, references):
+    # references: [{'attachment_id': sha256, 'filename': ...}] from the client;
+    # returns the formatted attachment list. Caller commits.
+    if not isinstance(references, list):
+        raise AttachmentError("attachments must be a list")
+    if len(references) > MAX_ATTACHMENTS_PER_MESSAGE:
+        raise AttachmentError(f"每条消息最多 {MAX_ATTACHMENTS_PER_MESSAGE} 个附件")
+    formatted = []
+    for ref in references:
+        sha256 = ref.get('attachment_id') if isinstance(ref, dict) else None
+        attachment = Attachment.query.get(sha256) if isinstance(sha256, str) else None
+        # Without the access check, knowing a hash would be enough to re-post a
+        # private attachment into a public channel
+        if not attachment or not can_access(user, sha256):
+            raise AttachmentError("附件不存在", 404)
+        filename = os.path.basename(str(ref.get('filename') or sha256))[:255]
+        db.session.add(MessageAttachment(message_id=message_id, attachment_sha256=sha256, filename=filename))
+        formatted.append(format_attachment(attachment, filename))
+    return formatted
+
+def format_attachment(attachment, filename):
+    return {
+        'attachment_id': attachment.sha256,
+        'filename': filename,
+        'size': attachment.size,
+        'content_type': attachment.content_type
+    }
+
+def attachments_for_messages(message_ids):
+    # {message_id: [formatted attachment, ...]} in one query, for history pages
+    if not message_ids:
+        return {}
+    rows = db.session.query(MessageAttachment, Attachment)\
+        .join(Attachment, MessageAttachment.attachment_sha256 == Attachment.sha256)\
+        .filter(MessageAttachment.message_id.in_(list(message_ids)))\
+        .order_by(MessageAttachment.id.asc())\
+        .all()
+    result = {}
+    for link, attachment in rows:
+        result.setdefault(link.message_id, []).append(format_attachment(attachment, link.filename))
+    return result
+
+def forget_messages(message_ids_query):
+    # Removes attachment links of messages about to be deleted; the stored
+    # objects are kept (they may be shared by other messages). Caller commits.
+    MessageAttachment.query.filter(MessageAttachment.message_id.in_(message_ids_query))\
+        .delete(synchronize_session=False)
@@ -0,0 +1,173 @@
+# Socket.IO 事件追踪与性能分析
+# - EventTraceRecorder: 记录入站事件的时间戳和负载结构到压缩文件 (gzip JSON lines)，
+#   音频和文本内容只保留长度，回放时再合成。由 replay_trace.py 回放。
+# - HandlerProfiler: 对事件处理函数做 cProfile 采样，并统计每个事件的耗时。
+# 两者都通过包装 python-socketio 服务器上已注册的事件处理函数实现，默认不启用。
+import atexit
+import cProfile
+import gzip
+import json
+import queue
+import threading
+import time
+from datetime import datetime
+
+TRACE_FORMAT = 'arc-event-trace'
+TRACE_VERSION = 1
+
+# Payload keys whose contents are never written to the trace
+AUDIO_KEYS = {'audio_data'}
+TEXT_KEYS = {'message', 'content', 'password', 'filename', 'sdp', 'candidate'}
+MAX_TRACED_LIST = 16
+
+
+def redact_payload(value, key=None):
+    if key in AUDIO_KEYS and isinstance(value, (list, tuple, bytes, bytearray)):
+        return {'__redacted__': 'audio', 'len': len(value)}
+    if key in TEXT_KEYS and isinstance(value, str):
+        return {'__redacted__': 'text', 'len': len(value)}
+    if isinstance(value, dict):
+        return {k: redact_payload(v, k) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        if len(value) > MAX_TRACED_LIST and all(isinstance(v, (int, float)) for v in value):
+            return {'__redacted__': 'numbers', 'len': len(value)}
+        return [redact_payload(v) for v in value]
+    if isinstance(value, (bytes, bytearray)):
+        return {'__redacted__': 'bytes', 'len': len(value)}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(type(value).__name__)
+
+def synthesize_payload(value):
+    # Inverse of redact_payload for replay: same shapes, synthetic contents
+    if isinstance(value, dict):
+        kind = value.get('__redacted__')
+        if kind == 'audio' or kind == 'numbers':
+            return [0.0] * value.get('len', 0)
+        if kind == 'text':
+            return 'x' * value.get('len', 0)
+        if kind == 'bytes':
+            return bytes(value.get('len', 0))
+        return {k: synthesize_payload(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [synthesize_payload(v) for v in value]
+    return value
+
+def read_trace(path):
+    # Yields (timestamp_offset, client_index, event, payload); payloads are still redacted
+    with gzip.open(path, 'rt', encoding='utf-8') as trace:
+        header = json.loads(trace.readline())
+        if header.get('format') != TRACE_FORMAT:
+            raise ValueError(f"{path} is not an event trace")
+        for line in trace:
+            t, client, event, payload = json.loads(line)
+            yield t, client, event, payload
+
+
+def _wrap_handlers(server, namespace, make_wrapper):
+    handlers = server.handlers.get(namespace, {})
+    for event, handler in list(handlers.items()):
+        handlers[event] = make_wrapper(event, handler)
+
+
+class EventTraceRecorder:
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        self._clients = {}  # sid -> small int, so traces don't contain session ids
+        self._clients_lock = threading.Lock()
+        self._started = time.monotonic()
+        # The file is opened on the first event, so the debug reloader's parent
+        # process (which never serves events) doesn't clobber the trace
+        self._writer = threading.Thread(target=self._write_loop, name='event-trace-writer', daemon=True)
+        atexit.register(self.close)
+
+    def install(self, socketio, namespace='/'):
+        # Must run after every @socketio.on handler has been registered
+        def make_wrapper(event, handler):
+            def traced(sid, *args):
+                # The connect handler also receives the WSGI environ; never record it
+                payload = None if event in ('connect', 'disconnect') else list(args)
+                self.record(sid, event, payload)
+                return handler(sid, *args)
+            return traced
+        _wrap_handlers(socketio.server, namespace, make_wrapper)
+        print(f"Recording Socket.IO event trace to {self.path}")
+
+    def record(self, sid, event, args):
+        t = round(time.monotonic() - self._started, 3)
+        with self._clients_lock:
+            client = self._clients.setdefault(sid, len(self._clients))
+            if not self._writer.is_alive() and self._writer.ident is None:
+                self._writer.start()
+        # Redact right away: handlers may mutate their payload (e.g. voice_signal).
+        # Audio is only measured, so this stays cheap on the voice path.
+        payload = redact_payload(args[0]) if args else None
+        self._queue.put((t, client, event, payload))
+
+    def _write_loop(self):
+        with gzip.open(self.path, 'wt', encoding='utf-8', compresslevel=6) as trace:
+            trace.write(json.dumps({'format': TRACE_FORMAT, 'version': TRACE_VERSION,
+                                    'started_at': datetime.utcnow().isoformat()}) + '\n')
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                t, client, event, payload = item
+                trace.write(json.dumps([t, client, event, payload], separators=(',', ':')) + '\n')
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=5)
+
+
+class HandlerProfiler:
+    # cProfile can only be active once per process (Python 3.12+), so handler
+    # calls are profiled whenever the profiler is free and merely timed when
+    # another thread holds it. Every call is counted in the per-event timings.
+    def __init__(self, path):
+        self.path = path
+        self._profile = cProfile.Profile()
+        self._profile_lock = threading.Lock()
+        self._timings = {}  # event -> [calls, total_seconds, max_seconds, profiled_calls]
+        self._timings_lock = threading.Lock()
+        atexit.register(self.dump)
+
+    def install(self, socketio, namespace='/'):
+        def make_wrapper(event, handler):
+            def profiled(sid, *args):
+                return self._call(event, handler, sid, *args)
+            return profiled
+        _wrap_handlers(socketio.server, namespace, make_wrapper)
+        print(f"Profiling Socket.IO handlers, stats will be written to {self.path}")
+
+    def _call(self, event, handler, *args):
+        profiled = self._profile_lock.acquire(blocking=False)
+        started = time.perf_counter()
+        try:
+            if profiled:
+                return self._profile.runcall(handler, *args)
+            return handler(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            if profiled:
+                self._profile_lock.release()
+            with self._timings_lock:
+                stats = self._timings.setdefault(event, [0, 0.0, 0.0, 0])
+                stats[0] += 1
+                stats[1] += elapsed
+                stats[2] = max(stats[2], elapsed)
+                stats[3] += 1 if profiled else 0
+
+    def dump(self):
+        if not self._timings:
+            return # Nothing was handled in this process (e.g. the debug reloader's parent)
+        with self._profile_lock:
+            self._profile.dump_stats(self.path)
+        with self._timings_lock:
+            rows = sorted(self._timings.items(), key=lambda item: item[1][1], reverse=True)
+        print(f"Handler profile written to {self.path} (inspect with: python -m pstats {self.path})")
+        print(f"{'event':<28}{'calls':>8}{'total ms':>12}{'avg ms':>10}{'max ms':>10}{'profiled':>10}")
+        for event, (calls, total, longest, profiled) in rows:
+            print(f"{event:<28}{calls:>8}{total * 1000:>12.1f}{total * 1000 / calls:>10.2f}{longest * 1000:>10.2f}{profiled:>10}")
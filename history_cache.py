@@ -0,0 +1,55 @@
+# 历史消息页缓存
+# 以 (channel, anchor, limit) 为键缓存已编码的历史消息页，热门频道只需编码一次。
+# 频道有新消息写入时按频道失效。
+import threading
+from collections import OrderedDict
+
+
+def _channel_key(channel_id):
+    # Clients may send channel ids as str or int; normalise so invalidation hits
+    try:
+        return int(channel_id)
+    except (TypeError, ValueError):
+        return channel_id
+
+
+class HistoryPageCache:
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._pages = OrderedDict()  # (channel, anchor, limit) -> prepared payload
+        self._generations = {}       # channel -> int, bumped on every invalidation
+        self._epoch = 0              # bumped by clear()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, channel_id, anchor, limit, builder):
+        channel = _channel_key(channel_id)
+        key = (channel, anchor, limit)
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+                return page
+            generation = (self._epoch, self._generations.get(channel, 0))
+
+        page = builder()
+
+        with self._lock:
+            # Don't store a page built from data that was invalidated meanwhile
+            if (self._epoch, self._generations.get(channel, 0)) == generation:
+                self._pages[key] = page
+                self._pages.move_to_end(key)
+                while len(self._pages) > self.max_entries:
+                    self._pages.popitem(last=False)
+        return page
+
+    def invalidate_channel(self, channel_id):
+        channel = _channel_key(channel_id)
+        with self._lock:
+            self._generations[channel] = self._generations.get(channel, 0) + 1
+            for key in [k for k in self._pages if k[0] == channel]:
+                del self._pages[key]
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._pages.clear()
@@ -51,4 +51,48 @@ class VoiceSession(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     channel_id = db.Column(db.Integer, db.ForeignKey('channel.id'), nullable=False)
     joined_at = db.Column(db.DateTime, default=datetime.utcnow)
-    is_muted = db.Column(db.Boolean, default=False) 
\ No newline at end of file
+    is_muted = db.Column(db.Boolean, default=False) 
+
+class ChannelStats(db.Model):
+    # 每个频道的消息计数器，发送消息时 O(1) 递增，避免对 Message 做 COUNT 扫描
+    channel_id = db.Column(db.Integer, db.ForeignKey('channel.id'), primary_key=True)
+    message_seq = db.Column(db.Integer, default=0, nullable=False)    # 只增不减的消息序号，用于计算未读数
+    message_count = db.Column(db.Integer, default=0, nullable=False)  # 频道内现存的消息数，删除消息时减少
+    last_message_id = db.Column(db.Integer, nullable=True)
+
+class ChannelReadState(db.Model):
+    # 每个用户在每个频道的已读位置
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    channel_id = db.Column(db.Integer, db.ForeignKey('channel.id'), primary_key=True)
+    last_read_message_id = db.Column(db.Integer, nullable=True)
+    last_read_seq = db.Column(db.Integer, default=0, nullable=False)  # 已读时频道的 message_seq
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class Attachment(db.Model):
+    # 内容寻址存储: 以文件内容的 sha256 为主键，相同内容只存一份
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    content_type = db.Column(db.String(100), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class AttachmentUploader(db.Model):
+    # 上传过某个附件的用户 (去重后同一内容可能有多个上传者)，用于下载权限检查
+    attachment_sha256 = db.Column(db.String(64), db.ForeignKey('attachment.sha256'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+
+class AttachmentUpload(db.Model):
+    # 进行中的分块上传，支持断点续传
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    content_type = db.Column(db.String(100), nullable=True)
+    size = db.Column(db.Integer, nullable=False)      # 声明的文件总大小
+    received = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class MessageAttachment(db.Model):
+    # 消息只保存对附件的引用
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=False, index=True)
+    attachment_sha256 = db.Column(db.String(64), db.ForeignKey('attachment.sha256'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
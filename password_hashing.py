@@ -0,0 +1,160 @@
+# 密码哈希卸载与登录限流
+# Werkzeug 的 KDF (scrypt / pbkdf2) 故意很慢，在请求线程里执行会占住 GIL，
+# 服务器重启后大量用户同时登录时会拖慢聊天和语音转发。
+# 这里把哈希计算放到有界的进程池中执行，并对用户名和 IP 做登录尝试限流。
+# 注意: 在 Windows / macOS 上进程池以 spawn 方式启动子进程，子进程会以 __mp_main__ 的名字
+# 重新执行父进程的主模块 (python app.py 时即 app.py 的全部模块级代码)，然后再导入本模块。
+# 因此本模块不能 import app，且 app.py 的模块级代码必须在工作进程中可以安全导入:
+# 不能启动服务、线程或子进程，也不能写文件 (这些都要放在 __main__ 分支内或延迟到首次使用时)。
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingBusy(Exception):
+    # Raised when the hashing queue is full; callers should answer 503
+    pass
+
+
+# --- Executed inside the worker processes ---
+
+_method_prefixes = {}
+
+def _method_prefix(method):
+    # The parameter prefix werkzeug writes for `method`, e.g. 'scrypt:32768:8:1'.
+    # Computed once per worker process.
+    if method not in _method_prefixes:
+        _method_prefixes[method] = generate_password_hash('', method=method).split('$', 1)[0]
+    return _method_prefixes[method]
+
+def _hash_password(password, method):
+    return generate_password_hash(password, method=method)
+
+def _verify_password(pwhash, password, method):
+    # Returns (matches, new_hash); new_hash is set when the stored hash was made
+    # with different parameters and should be replaced
+    if not check_password_hash(pwhash, password):
+        return False, None
+    if pwhash.split('$', 1)[0] != _method_prefix(method):
+        return True, generate_password_hash(password, method=method)
+    return True, None
+
+
+# --- Used by the request threads ---
+
+class PasswordHasher:
+    def __init__(self, method='scrypt', workers=2, max_pending=64, timeout=30):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _get_executor(self):
+        # Created lazily so importing app.py doesn't spawn processes
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._reset_executor()
+            raise HashingBusy()
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        # Waiting on the future releases the GIL; the KDF runs in another process
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise HashingBusy()
+        except BrokenProcessPool:
+            # A worker died (e.g. killed by the OS); start a fresh pool next time
+            self._reset_executor()
+            raise HashingBusy()
+
+    def _reset_executor(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def hash(self, password):
+        return self._run(_hash_password, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(_verify_password, pwhash, password, self.method)
+
+
+class LoginThrottle:
+    # Sliding-window attempt limits per IP (all attempts) and per username (failures)
+    SWEEP_THRESHOLD = 4096
+
+    def __init__(self, max_per_ip=20, ip_window=60, max_failures_per_user=5, user_window=300):
+        self.max_per_ip = max_per_ip
+        self.ip_window = ip_window
+        self.max_failures_per_user = max_failures_per_user
+        self.user_window = user_window
+        self._ip_attempts = {}     # ip -> deque of timestamps
+        self._user_failures = {}   # username -> deque of timestamps
+        self._lock = threading.Lock()
+
+    def _sweep(self, now):
+        # Drop idle keys so one-off IPs and usernames don't accumulate forever
+        for table, window in ((self._ip_attempts, self.ip_window), (self._user_failures, self.user_window)):
+            for key in list(table):
+                self._prune(table[key], window, now)
+                if not table[key]:
+                    del table[key]
+
+    @staticmethod
+    def _prune(entries, window, now):
+        while entries and entries[0] <= now - window:
+            entries.popleft()
+
+    def _retry_after(self, table, key, limit, window, now):
+        entries = table.get(key)
+        if not entries:
+            return 0
+        self._prune(entries, window, now)
+        if not entries:
+            del table[key]
+            return 0
+        if len(entries) >= limit:
+            return max(1, int(entries[0] + window - now) + 1)
+        return 0
+
+    def check(self, username, ip):
+        # Records an attempt from `ip`; returns seconds to wait, or 0 if allowed
+        now = time.monotonic()
+        with self._lock:
+            if max(len(self._ip_attempts), len(self._user_failures)) > self.SWEEP_THRESHOLD:
+                self._sweep(now)
+            retry_after = max(
+                self._retry_after(self._ip_attempts, ip, self.max_per_ip, self.ip_window, now),
+                self._retry_after(self._user_failures, username, self.max_failures_per_user, self.user_window, now)
+                if username else 0
+            )
+            if retry_after:
+                return retry_after
+            self._ip_attempts.setdefault(ip, deque()).append(now)
+            return 0
+
+    def record_failure(self, username):
+        with self._lock:
+            self._user_failures.setdefault(username, deque()).append(time.monotonic())
+
+    def record_success(self, username):
+        with self._lock:
+            self._user_failures.pop(username, None)
@@ -0,0 +1,131 @@
+# 已读状态与未读计数
+# 每个频道维护一个只增不减的消息序号 (ChannelStats.message_seq)，发送消息时 O(1) 递增；
+# 每个用户记录已读时的序号 (ChannelReadState.last_read_seq)。
+# 未读数 = message_seq - last_read_seq，无需对 Message 做 COUNT 扫描。
+# 现存消息数单独保存在 message_count 中，删除消息时只减少它，不影响已读位置。
+from sqlalchemy import func
+from models import db, Channel, Message, ChannelStats, ChannelReadState
+
+
+def seed_channel_stats():
+    # One-off migration for channels created before the counters existed.
+    # Runs a single grouped COUNT at startup; the send path never counts.
+    seeded_ids = {row.channel_id for row in ChannelStats.query.all()}
+    missing_ids = [ch.id for ch in Channel.query.all() if ch.id not in seeded_ids]
+    if not missing_ids:
+        return
+
+    counts = dict(
+        db.session.query(Message.channel_id, func.count(Message.id))
+        .filter(Message.channel_id.in_(missing_ids))
+        .group_by(Message.channel_id)
+        .all()
+    )
+    last_ids = dict(
+        db.session.query(Message.channel_id, func.max(Message.id))
+        .filter(Message.channel_id.in_(missing_ids))
+        .group_by(Message.channel_id)
+        .all()
+    )
+    for channel_id in missing_ids:
+        db.session.add(ChannelStats(
+            channel_id=channel_id,
+            message_seq=counts.get(channel_id, 0),
+            message_count=counts.get(channel_id, 0),
+            last_message_id=last_ids.get(channel_id)
+        ))
+    db.session.commit()
+    print(f"Seeded message counters for {len(missing_ids)} channel(s).")
+
+def init_channel_stats(channel_id):
+    # Called when a channel is created; caller commits
+    db.session.add(ChannelStats(channel_id=channel_id, message_seq=0, message_count=0))
+
+def record_message(channel_id, message_id, sender_id):
+    # O(1) counter bump in the send path; caller commits together with the message.
+    # The sender has read their own message, so their read state moves along with it.
+    updated = ChannelStats.query.filter_by(channel_id=channel_id).update({
+        ChannelStats.message_seq: ChannelStats.message_seq + 1,
+        ChannelStats.message_count: ChannelStats.message_count + 1,
+        ChannelStats.last_message_id: message_id
+    }, synchronize_session=False)
+    if updated:
+        message_seq = db.session.query(ChannelStats.message_seq).filter_by(channel_id=channel_id).scalar()
+    else:
+        # Channel has no counter row yet (e.g. created by an older server version);
+        # the new message is already flushed, so it is part of the count
+        message_seq = Message.query.filter_by(channel_id=channel_id).count()
+        db.session.add(ChannelStats(channel_id=channel_id, message_seq=message_seq, message_count=message_seq,
+                                    last_message_id=message_id))
+
+    state = ChannelReadState.query.get((sender_id, channel_id))
+    if state is None:
+        state = ChannelReadState(user_id=sender_id, channel_id=channel_id)
+        db.session.add(state)
+    state.last_read_seq = message_seq
+    state.last_read_message_id = message_id
+
+def channel_message_count(channel_id):
+    stats = ChannelStats.query.get(channel_id)
+    if stats is None:
+        return Message.query.filter_by(channel_id=channel_id).count()
+    return stats.message_count
+
+def mark_read(user_id, channel_id):
+    # Marks everything currently in the channel as read; returns the new read state
+    stats = ChannelStats.query.get(channel_id)
+    message_seq = stats.message_seq if stats else 0
+    last_message_id = stats.last_message_id if stats else None
+
+    state = ChannelReadState.query.get((user_id, channel_id))
+    if state is None:
+        state = ChannelReadState(user_id=user_id, channel_id=channel_id)
+        db.session.add(state)
+    elif state.last_read_seq == message_seq and state.last_read_message_id == last_message_id:
+        return state # Already up to date, skip the write
+    state.last_read_seq = message_seq
+    state.last_read_message_id = last_message_id
+    db.session.commit()
+    return state
+
+def unread_summary(user_id, channel_ids):
+    # {channel_id: unread_count} for the given channels, non-zero entries only
+    if not channel_ids:
+        return {}
+    stats_rows = ChannelStats.query.filter(ChannelStats.channel_id.in_(channel_ids)).all()
+    read_seqs = dict(
+        db.session.query(ChannelReadState.channel_id, ChannelReadState.last_read_seq)
+        .filter(ChannelReadState.user_id == user_id, ChannelReadState.channel_id.in_(channel_ids))
+        .all()
+    )
+    summary = {}
+    for stats in stats_rows:
+        unread = stats.message_seq - read_seqs.get(stats.channel_id, 0)
+        if unread > 0:
+            summary[stats.channel_id] = unread
+    return summary
+
+def forget_channel(channel_id):
+    # Called when a channel is deleted; caller commits
+    ChannelReadState.query.filter_by(channel_id=channel_id).delete()
+    ChannelStats.query.filter_by(channel_id=channel_id).delete()
+
+def forget_user_messages(user_id):
+    # Called before a user's messages are bulk-deleted; caller commits.
+    # message_seq is never lowered: it is what everyone's last_read_seq is
+    # compared against, so lowering it would hide (or swallow) unread messages.
+    per_channel = (
+        db.session.query(Message.channel_id, func.count(Message.id))
+        .filter(Message.user_id == user_id)
+        .group_by(Message.channel_id)
+        .all()
+    )
+    for channel_id, removed in per_channel:
+        remaining_last_id = db.session.query(func.max(Message.id))\
+            .filter(Message.channel_id == channel_id, Message.user_id != user_id)\
+            .scalar()
+        ChannelStats.query.filter_by(channel_id=channel_id).update({
+            ChannelStats.message_count: ChannelStats.message_count - removed,
+            ChannelStats.last_message_id: remaining_last_id
+        }, synchronize_session=False)
+    ChannelReadState.query.filter_by(user_id=user_id).delete()
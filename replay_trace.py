@@ -0,0 +1,141 @@
+# 事件追踪回放工具
+# 按 1 倍或加速的速度，把 event_trace.py 录制的事件流回放到本地服务器，用于复现线上负载并做性能分析。
+#
+# 用法:
+#   1. 录制: 设置环境变量 ARC_EVENT_TRACE=trace.jsonl.gz 后启动线上服务器
+#   2. 在本地启动服务器并开启处理函数分析: ARC_EVENT_PROFILE=handlers.prof python app.py
+#      (也可以用采样分析器附加到服务器进程，例如 py-spy record --pid <PID>)
+#   3. 回放: python replay_trace.py trace.jsonl.gz --server https://localhost:5005 --speed 4
+#   4. 停止服务器后查看分析结果: python -m pstats handlers.prof
+import argparse
+import time
+from collections import Counter
+
+import requests
+import socketio
+
+from event_trace import read_trace, synthesize_payload
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Replay a recorded Socket.IO event trace against a server.')
+    parser.add_argument('trace', help='trace file written by ARC_EVENT_TRACE')
+    parser.add_argument('--server', default='https://localhost:5005')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='playback speed multiplier; 0 replays as fast as possible')
+    parser.add_argument('--user-prefix', default='replay_user_',
+                        help='each traced client is replayed as <prefix><n>, registered on demand')
+    parser.add_argument('--password', default='replay-password')
+    parser.add_argument('--invite-code', default='ARC2015')
+    parser.add_argument('--channel-map', default='',
+                        help='remap traced channel ids, e.g. "7=1,8=2"')
+    parser.add_argument('--verify-ssl', action='store_true',
+                        help='verify the server certificate (off by default for self-signed certs)')
+    return parser.parse_args()
+
+def parse_channel_map(spec):
+    mapping = {}
+    for pair in filter(None, spec.split(',')):
+        source, target = pair.split('=')
+        mapping[int(source)] = int(target)
+    return mapping
+
+def remap_channels(payload, mapping):
+    if isinstance(payload, dict):
+        return {k: (mapping.get(v, v) if k == 'channel_id' else remap_channels(v, mapping))
+                for k, v in payload.items()}
+    if isinstance(payload, list):
+        return [remap_channels(v, mapping) for v in payload]
+    return payload
+
+
+class ReplayClient:
+    def __init__(self, index, args):
+        self.args = args
+        self.username = f"{args.user_prefix}{index}"
+        self.session = requests.Session()
+        self.session.verify = args.verify_ssl
+        self.sio = None
+
+    def _post(self, path, body):
+        # The server throttles logins per IP and sheds load with 503; wait and retry
+        while True:
+            response = self.session.post(self.args.server + path, json=body)
+            if response.status_code not in (429, 503):
+                return response
+            time.sleep(int(response.headers.get('Retry-After', '1')))
+
+    def login(self):
+        credentials = {'username': self.username, 'password': self.args.password}
+        response = self._post('/api/login', credentials)
+        if response.status_code == 401:
+            self._post('/api/register', dict(credentials, invite_code=self.args.invite_code))
+            response = self._post('/api/login', credentials)
+        if not response.ok:
+            raise RuntimeError(f"Login failed for {self.username}: {response.status_code} {response.text}")
+
+    def connect(self):
+        if self.sio is not None and self.sio.connected:
+            return
+        self.sio = socketio.Client(http_session=self.session, ssl_verify=self.args.verify_ssl)
+        self.sio.connect(self.args.server, transports=['websocket'])
+
+    def disconnect(self):
+        if self.sio is not None and self.sio.connected:
+            self.sio.disconnect()
+
+    def emit(self, event, payload):
+        self.connect()
+        if payload is None:
+            self.sio.emit(event)
+        else:
+            self.sio.emit(event, payload)
+
+
+def main():
+    args = parse_args()
+    channel_map = parse_channel_map(args.channel_map)
+    records = list(read_trace(args.trace))
+    if not records:
+        print("Trace is empty.")
+        return
+
+    clients = {index: ReplayClient(index, args) for index in sorted({r[1] for r in records})}
+    print(f"Logging in {len(clients)} replay client(s)...")
+    for client in clients.values():
+        client.login()
+
+    print(f"Replaying {len(records)} events at {'max' if args.speed <= 0 else args.speed}x speed...")
+    sent = Counter()
+    max_lag = 0.0
+    first_t = records[0][0]
+    started = time.monotonic()
+    try:
+        for t, index, event, payload in records:
+            if args.speed > 0:
+                due = started + (t - first_t) / args.speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    max_lag = max(max_lag, -delay)
+
+            client = clients[index]
+            if event == 'connect':
+                client.connect()
+            elif event == 'disconnect':
+                client.disconnect()
+            else:
+                client.emit(event, remap_channels(synthesize_payload(payload), channel_map))
+            sent[event] += 1
+    finally:
+        for client in clients.values():
+            client.disconnect()
+
+    elapsed = time.monotonic() - started
+    print(f"Replayed {sum(sent.values())} events in {elapsed:.1f}s (max lag behind schedule: {max_lag * 1000:.0f} ms)")
+    for event, count in sent.most_common():
+        print(f"  {event:<28}{count:>8}")
+
+if __name__ == '__main__':
+    main()
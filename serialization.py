@@ -0,0 +1,111 @@
+# Socket.IO 数据包序列化层
+# 在 SocketIO 实例上配置可插拔的序列化后端 (orjson / 标准库 json / msgpack)，
+# 并支持 "只编码一次" 的预编码负载 (EncodedPayload)，供历史消息缓存复用。
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson 是可选依赖
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # msgpack 是可选依赖
+    msgpack = None
+
+
+class EncodedPayload:
+    # A payload dict together with its JSON encoding, computed at most once.
+    __slots__ = ('payload', '_encoded', '_backend')
+
+    def __init__(self, payload, backend):
+        self.payload = payload
+        self._encoded = None
+        self._backend = backend
+
+    @property
+    def encoded(self):
+        if self._encoded is None:
+            self._encoded = self._backend.encode_plain(self.payload)
+        return self._encoded
+
+
+class _JsonBackend:
+    # Module-like object passed to SocketIO(json=...). python-socketio and
+    # python-engineio call dumps(data, separators=...) / loads(data).
+    name = 'json'
+
+    def encode_plain(self, obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj, *args, **kwargs):
+        if isinstance(obj, EncodedPayload):
+            return obj.encoded
+        # A Socket.IO event packet is encoded as [event, arg1, ...]; splice
+        # pre-encoded arguments in verbatim instead of re-encoding them.
+        if isinstance(obj, list) and any(isinstance(item, EncodedPayload) for item in obj):
+            parts = [item.encoded if isinstance(item, EncodedPayload) else self.encode_plain(item)
+                     for item in obj]
+            return '[' + ','.join(parts) + ']'
+        return self.encode_plain(obj)
+
+    def loads(self, data, *args, **kwargs):
+        return self.decode(data)
+
+
+class _OrjsonBackend(_JsonBackend):
+    name = 'orjson'
+
+    def encode_plain(self, obj):
+        # OPT_NON_STR_KEYS keeps parity with the stdlib for int-keyed dicts
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class SocketSerializer:
+    # Resolved serializer configuration for the SocketIO instance.
+
+    def __init__(self, name, json_backend=None):
+        self.name = name
+        self.json_backend = json_backend
+
+    def socketio_options(self):
+        if self.name == 'msgpack':
+            return {'serializer': 'msgpack'}
+        return {'json': self.json_backend}
+
+    def prepare(self, payload):
+        # Wrap a payload so that it is encoded once and reusable across emits.
+        # msgpack packets are binary and cannot splice pre-encoded JSON.
+        if self.json_backend is None:
+            return payload
+        return EncodedPayload(payload, self.json_backend)
+
+
+def create_serializer(preference='auto'):
+    # preference: 'auto' | 'orjson' | 'json' | 'msgpack'
+    preference = (preference or 'auto').lower()
+
+    if preference == 'msgpack':
+        if msgpack is not None:
+            return SocketSerializer('msgpack')
+        print("msgpack is not installed, falling back to JSON serializer.")
+        preference = 'auto'
+
+    if preference in ('auto', 'orjson') and orjson is not None:
+        return SocketSerializer('orjson', _OrjsonBackend())
+    if preference == 'orjson':
+        print("orjson is not installed, falling back to stdlib json serializer.")
+    return SocketSerializer('json', _JsonBackend())
+
+
+def unwrap(prepared):
+    # The plain payload dict behind a (possibly pre-encoded) prepared payload
+    if isinstance(prepared, EncodedPayload):
+        return prepared.payload
+    return prepared
@@ -0,0 +1,333 @@
+# 语音频道录音 (用于管理员审核)
+# 转发路径只把音频帧放进预分配的环形缓冲区，不做任何磁盘 I/O，缓冲区满时丢帧并计数；
+# 入队前把帧转换为 float32 数组 (每个采样 4 字节，而 Python float 列表约 32 字节)，且每帧采样数有上限，
+# 超出的帧直接丢弃，因此每个录音频道的缓冲区内存上限约为 ring_frames × max_frame_samples × 4 字节；
+# 后台线程取出音频帧，按接收时间对齐各说话人，混音或分轨后写入压缩的分段文件。
+# 依赖 numpy (可选依赖，未安装时录音功能不可用)；安装了 soundfile 时写 FLAC，否则写 gzip 压缩的 WAV。
+import gzip
+import os
+import threading
+import time
+import wave
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:  # numpy 是可选依赖
+    np = None
+
+try:
+    import soundfile
+except ImportError:  # soundfile 是可选依赖
+    soundfile = None
+
+DRAIN_INTERVAL = 0.25   # 后台线程取帧间隔 (秒)
+DRAIN_BATCH = 256       # 每次持锁最多取出的帧数
+
+
+class RecorderUnavailable(Exception):
+    pass
+
+
+class RecordingModeConflict(Exception):
+    # The channel is already being recorded in another mode
+    def __init__(self, mode):
+        super().__init__(f"频道已在以 '{mode}' 模式录音，请先停止录音")
+        self.mode = mode
+
+
+class FrameRing:
+    # Fixed-capacity ring of (timestamp, user_id, float32 frame). Producers only touch
+    # the slots under a short lock (no allocation, no I/O) and never wait for
+    # the writer; when the ring is full the new frame is dropped and counted.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._timestamps = [0.0] * capacity
+        self._user_ids = [0] * capacity
+        self._frames = [None] * capacity
+        self._head = 0  # next slot to write
+        self._tail = 0  # next slot to read
+        self._size = 0
+        self._lock = threading.Lock()
+        self.dropped = 0
+        self.rejected = 0  # Frames refused before queueing (oversized or malformed)
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def offer(self, timestamp, user_id, frame):
+        with self._lock:
+            if self._size == self.capacity:
+                self.dropped += 1
+                return False
+            i = self._head
+            self._timestamps[i] = timestamp
+            self._user_ids[i] = user_id
+            self._frames[i] = frame
+            self._head = (i + 1) % self.capacity
+            self._size += 1
+            return True
+
+    def drain(self, out, max_items):
+        with self._lock:
+            count = min(self._size, max_items)
+            for _ in range(count):
+                i = self._tail
+                out.append((self._timestamps[i], self._user_ids[i], self._frames[i]))
+                self._frames[i] = None # Release the frame for garbage collection
+                self._tail = (i + 1) % self.capacity
+            self._size -= count
+        return count
+
+    def __len__(self):
+        return self._size
+
+
+class VoiceChannelRecorder:
+    def __init__(self, channel_id, output_dir, mode='mix', sample_rate=48000,
+                 segment_seconds=30, ring_frames=1024, max_frame_samples=9600):
+        if np is None:
+            raise RecorderUnavailable("录音功能需要安装 numpy")
+        if mode not in ('mix', 'tracks'):
+            raise ValueError("mode must be 'mix' or 'tracks'")
+
+        self.channel_id = channel_id
+        self.output_dir = output_dir
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.segment_seconds = segment_seconds
+        self.max_frame_samples = max_frame_samples
+        self.ring = FrameRing(ring_frames)
+        self.started_at = datetime.utcnow()
+
+        self.frames_written = 0
+        self.late_frames = 0     # Arrived after their segment was already written
+        self.segments_written = 0
+        self._reported_dropped = 0
+
+        # Per-segment state, only touched by the writer thread. Each track has
+        # one second of slack so frames that straddle the boundary fit.
+        self._segment_samples = int(sample_rate * segment_seconds)
+        self._track_samples = self._segment_samples + sample_rate
+        self._segment_start = None
+        self._segment_wall = None
+        self._segment_index = 0
+        self._tracks = {}  # user_id -> [np.float32 buffer, cursor]
+
+        os.makedirs(output_dir, exist_ok=True)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"voice-recorder-{channel_id}", daemon=True)
+        self._thread.start()
+
+    def offer(self, user_id, audio_data):
+        # Called from the relay path: never touches the disk. The frame is
+        # copied into a compact float32 array (one C-level pass) so the ring
+        # holds 4 bytes per sample rather than the client's list of floats;
+        # together with the frame size cap this bounds the ring's memory.
+        if not isinstance(audio_data, (list, tuple)) or not 0 < len(audio_data) <= self.max_frame_samples:
+            self.ring.reject()
+            return False
+        try:
+            samples = np.asarray(audio_data, dtype=np.float32)
+        except (TypeError, ValueError):
+            samples = None
+        if samples is None or samples.ndim != 1:
+            self.ring.reject()
+            return False
+        return self.ring.offer(time.monotonic(), user_id, samples)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=10)
+
+    def status(self):
+        return {
+            'channel_id': self.channel_id,
+            'mode': self.mode,
+            'started_at': self.started_at.isoformat(),
+            'frames_written': self.frames_written,
+            'dropped_frames': self.ring.dropped,
+            'rejected_frames': self.ring.rejected,
+            'late_frames': self.late_frames,
+            'segments_written': self.segments_written,
+            'buffered_frames': len(self.ring),
+            'buffer_capacity': self.ring.capacity
+        }
+
+    # --- Writer thread ---
+
+    def _run(self):
+        batch = []
+        while not self._stop.wait(DRAIN_INTERVAL):
+            self._drain(batch)
+            if self._segment_start is not None and \
+                    time.monotonic() >= self._segment_start + self.segment_seconds + 1:
+                # Speakers went quiet; write the finished segment instead of holding it
+                self._flush_segment()
+                self._segment_start = None
+            self._report_drops()
+        self._drain(batch)
+        self._flush_segment()
+        self._report_drops()
+
+    def _drain(self, batch):
+        while self.ring.drain(batch, DRAIN_BATCH):
+            for timestamp, user_id, frame in batch:
+                self._place(timestamp, user_id, frame)
+            batch.clear()
+
+    def _advance_segment(self):
+        self._flush_segment()
+        self._segment_start += self.segment_seconds
+
+    def _place(self, timestamp, user_id, samples):
+
+        # A frame is received right after it was captured, so it ends at `timestamp`
+        frame_start = timestamp - samples.size / self.sample_rate
+        if self._segment_start is None:
+            self._segment_start = frame_start
+        elif frame_start >= self._segment_start + 2 * self.segment_seconds:
+            # Long silence: start the next segment at this frame
+            self._flush_segment()
+            self._segment_start = frame_start
+        elif frame_start >= self._segment_start + self.segment_seconds:
+            self._advance_segment()
+        if frame_start < self._segment_start - 1:
+            self.late_frames += 1
+            return
+        if self._segment_wall is None:
+            self._segment_wall = datetime.utcnow()
+
+        track = self._tracks.get(user_id)
+        if track is None:
+            track = self._tracks[user_id] = [np.zeros(self._track_samples, dtype=np.float32), 0]
+        buffer, cursor = track
+        # Align by receive time, but never overlap this speaker's previous frame (jitter)
+        position = max(cursor, int((frame_start - self._segment_start) * self.sample_rate), 0)
+        length = min(samples.size, self._track_samples - position)
+        if length <= 0:
+            self.late_frames += 1
+            return
+        buffer[position:position + length] = samples[:length]
+        track[1] = position + length
+        self.frames_written += 1
+
+    def _flush_segment(self):
+        if not self._tracks:
+            return
+        length = max(cursor for _, cursor in self._tracks.values())
+        stamp = (self._segment_wall or datetime.utcnow()).strftime('%Y%m%d-%H%M%S')
+        prefix = os.path.join(self.output_dir, f"{stamp}_seg{self._segment_index:04d}")
+        try:
+            if self.mode == 'mix':
+                mixed = np.zeros(length, dtype=np.float32)
+                for buffer, _ in self._tracks.values():
+                    mixed += buffer[:length]
+                self._write_audio(f"{prefix}_mix", mixed)
+            else:
+                for user_id, (buffer, cursor) in self._tracks.items():
+                    self._write_audio(f"{prefix}_user{user_id}", buffer[:length])
+            self.segments_written += 1
+        except OSError as e:
+            print(f"[VOICE_RECORDER] Failed to write segment for channel {self.channel_id}: {e}")
+        self._tracks = {}
+        self._segment_wall = None
+        self._segment_index += 1
+
+    def _write_audio(self, path_without_ext, samples):
+        pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype('<i2')
+        if soundfile is not None:
+            soundfile.write(f"{path_without_ext}.flac", pcm, self.sample_rate, subtype='PCM_16')
+            return
+        with gzip.open(f"{path_without_ext}.wav.gz", 'wb') as compressed:
+            with wave.open(compressed, 'wb') as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(self.sample_rate)
+                wav.setnframes(pcm.size) # Header is final up front, no seek needed on the gzip stream
+                wav.writeframes(pcm.tobytes())
+
+    def _report_drops(self):
+        dropped = self.ring.dropped
+        if dropped != self._reported_dropped:
+            print(f"[VOICE_RECORDER] Channel {self.channel_id}: writer fell behind, "
+                  f"{dropped - self._reported_dropped} frame(s) dropped ({dropped} total)")
+            self._reported_dropped = dropped
+
+
+class VoiceRecordingManager:
+    def __init__(self, root, **recorder_options):
+        self.root = root
+        self.recorder_options = recorder_options
+        self._recorders = {}  # channel_id -> VoiceChannelRecorder
+        # user_id -> voice channel_id, kept up to date by the join/leave handlers
+        # so tap() can check membership without touching the database
+        self._speakers = {}
+        self._lock = threading.Lock()
+
+    def start(self, channel_id, mode='mix', members=()):
+        # members: user ids already in the channel (e.g. sessions that survived a restart)
+        with self._lock:
+            for user_id in members:
+                self._speakers.setdefault(user_id, channel_id)
+            recorder = self._recorders.get(channel_id)
+            if recorder is not None and recorder.mode != mode:
+                raise RecordingModeConflict(recorder.mode)
+            if recorder is None:
+                output_dir = os.path.join(self.root, f"channel_{channel_id}")
+                recorder = VoiceChannelRecorder(channel_id, output_dir, mode=mode, **self.recorder_options)
+                self._recorders[channel_id] = recorder
+            return recorder
+
+    def stop(self, channel_id):
+        with self._lock:
+            recorder = self._recorders.pop(channel_id, None)
+        if recorder is not None:
+            recorder.stop() # Flushes the last segment
+        return recorder
+
+    def stop_all(self):
+        for channel_id in list(self._recorders):
+            self.stop(channel_id)
+
+    def get(self, channel_id):
+        return self._recorders.get(channel_id)
+
+    def set_speaker(self, user_id, channel_id):
+        # Called when a user joins (or switches to) a voice channel
+        with self._lock:
+            self._speakers[user_id] = channel_id
+
+    def forget_speaker(self, user_id):
+        # Called when a user leaves their voice channel or disconnects
+        with self._lock:
+            self._speakers.pop(user_id, None)
+
+    def forget_channel(self, channel_id):
+        # Called when a voice channel is deleted
+        with self._lock:
+            for user_id, speaker_channel in list(self._speakers.items()):
+                if speaker_channel == channel_id:
+                    del self._speakers[user_id]
+
+    def tap(self, channel_id, user_id, audio_data):
+        # Relay-path hook; a plain dict lookup when nothing is being recorded.
+        # Audio from users who are not in the channel never ends up in a
+        # moderation recording; the check is in-memory, no database I/O here.
+        if not self._recorders:
+            return
+        try:
+            channel_id = int(channel_id)
+        except (TypeError, ValueError):
+            return
+        recorder = self._recorders.get(channel_id)
+        if recorder is None:
+            return
+
+        with self._lock:
+            is_member = self._speakers.get(user_id) == channel_id
+        if not is_member:
+            recorder.ring.reject()
+            return
+        recorder.offer(user_id, audio_data)